@@ -0,0 +1,177 @@
+# cython: language_level=3
+"""
+Compiled versions of the per-line parsing functions in parse_access_log.py.
+
+These behave identically to the pure Python versions, which
+parse_access_log.py falls back to if this module has not been built.
+See the README for build instructions.
+"""
+
+cdef extern from "Python.h":
+    Py_ssize_t PyUnicode_FindChar(
+        object s, Py_UCS4 ch, Py_ssize_t start, Py_ssize_t end, int direction
+    ) except -2
+
+
+cdef inline Py_ssize_t _find(str s, Py_UCS4 ch, Py_ssize_t start):
+    return PyUnicode_FindChar(s, ch, start, len(s), 1)
+
+
+cdef bint _follows_address(str s, Py_ssize_t pos):
+    # Equivalent to the `[0-9.]{4}` address pattern in `_COMBINED_RE`.
+    cdef Py_ssize_t i
+    cdef Py_UCS4 ch
+    if pos < 4:
+        return False
+    for i in range(pos - 4, pos):
+        ch = s[i]
+        if not ("0" <= ch <= "9" or ch == "."):
+            return False
+    return True
+
+
+cdef bint _is_ascii_number(str value):
+    return value.isascii() and value.isdigit()
+
+
+def split_combined_log_line(str line):
+    """
+    Split an nginx "combined" format log line into fields.
+
+    See `_split_combined_log_line` in parse_access_log.py.
+    """
+    cdef Py_ssize_t end = len(line)
+    cdef Py_ssize_t addr_start, addr_end, user_end, time_end
+    cdef Py_ssize_t request_start, request_end, referrer_start, referrer_end
+    cdef Py_ssize_t user_agent_start, user_agent_end
+
+    # `$remote_addr - $remote_user [$time_local]`. Use the first " - " which
+    # follows an address.
+    addr_end = line.find(" - ")
+    while addr_end != -1 and not _follows_address(line, addr_end):
+        addr_end = line.find(" - ", addr_end + 1)
+    if addr_end == -1:
+        return None
+    addr_start = PyUnicode_FindChar(line, " ", 0, addr_end, -1) + 1
+    user_end = _find(line, " ", addr_end + 3)
+    if (
+        user_end == -1
+        or user_end == addr_end + 3
+        or user_end + 1 >= end
+        or line[user_end + 1] != "["
+    ):
+        return None
+    time_end = _find(line, "]", user_end + 2)
+    if time_end == -1 or time_end == user_end + 2:
+        return None
+
+    # `"$request" $status $body_bytes_sent`
+    if time_end + 2 >= end or line[time_end + 1] != " " or line[time_end + 2] != '"':
+        return None
+    request_start = time_end + 3
+    request_end = _find(line, '"', request_start)
+    if request_end == -1:
+        return None
+    referrer_start = _find(line, '"', request_end + 1) + 1
+    if referrer_start == 0:
+        return None
+    if line[request_end + 1] != " " or line[referrer_start - 2] != " ":
+        return None
+    try:
+        status, body_size = line[request_end + 2 : referrer_start - 2].split(" ")
+        if not (_is_ascii_number(status) and _is_ascii_number(body_size)):
+            return None
+        status = int(status)
+        body_size = int(body_size)
+    except ValueError:
+        return None
+
+    # `"$http_referer" "$http_user_agent"`
+    referrer_end = _find(line, '"', referrer_start)
+    if referrer_end == -1:
+        return None
+    if (
+        referrer_end + 2 >= end
+        or line[referrer_end + 1] != " "
+        or line[referrer_end + 2] != '"'
+    ):
+        return None
+    user_agent_start = referrer_end + 3
+    user_agent_end = _find(line, '"', user_agent_start)
+    if user_agent_end == -1:
+        return None
+
+    return (
+        line[addr_start:addr_end],
+        line[user_end + 2 : time_end],
+        line[request_start:request_end],
+        status,
+        body_size,
+        line[referrer_start:referrer_end],
+        line[user_agent_start:user_agent_end],
+    )
+
+
+def parse_user_agent(str user_agent_str):
+    """
+    Parse an HTTP User-Agent header.
+
+    See `parse_user_agent` in parse_access_log.py.
+    """
+    cdef Py_ssize_t end, pos, name_end, version_end, comment_end
+    cdef int depth
+    cdef Py_UCS4 ch
+
+    product_tokens = []
+
+    user_agent_str = user_agent_str.strip()
+    end = len(user_agent_str)
+    pos = 0
+
+    while True:
+        # Parse product name and version. This is equivalent to matching
+        # `_NAME_VERSION_RE`.
+        name_end = pos
+        while name_end < end:
+            ch = user_agent_str[name_end]
+            if ch == " " or ch == "." or ch == "_" or ch.isalnum():
+                name_end += 1
+            else:
+                break
+        if name_end == pos:
+            break
+        name = user_agent_str[pos:name_end]
+        version = None
+        pos = name_end
+        if pos < end and user_agent_str[pos] == "/":
+            version_end = pos + 1
+            while version_end < end and user_agent_str[version_end] != " ":
+                version_end += 1
+            if version_end > pos + 1:
+                version = user_agent_str[pos + 1 : version_end]
+                pos = version_end
+        while pos < end and user_agent_str[pos].isspace():
+            pos += 1
+
+        # Parse comment.
+        comment = None
+        if pos < end and user_agent_str[pos] == "(":
+            comment_end = pos
+            depth = 1
+            while comment_end < end - 1:
+                comment_end += 1
+                ch = user_agent_str[comment_end]
+                if ch == "(":
+                    depth += 1
+                elif ch == ")":
+                    depth -= 1
+                    if depth == 0:
+                        break
+            comment = user_agent_str[pos + 1 : comment_end]
+            pos = comment_end + 1
+            while pos < end and user_agent_str[pos].isspace():
+                pos += 1
+
+        product_tokens.append((name, version, comment))
+
+    return product_tokens
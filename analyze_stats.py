@@ -1,7 +1,47 @@
 from argparse import ArgumentParser
+from collections.abc import Callable
+import contextlib
 import csv
+import mmap
+import operator
+import os
 import re
+import stat
 import sys
+from typing import Optional
+
+try:
+    # pandas and pyarrow are optional dependencies, used to read Parquet files
+    # and to match rows against queries using vectorized operations.
+    import pandas  # noqa: F401 (required by `pyarrow.Table.to_pandas`)
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+_QUERY_TERM_RE = re.compile(r"(\w+)\s*(<|<=|==|>=|>)\s*(\d+)")
+
+# Columns of the CSV files produced by parse_access_log.py.
+_COLUMN_NAMES = [
+    "browser_name",
+    "browser_version",
+    "equivalent_name",
+    "equivalent_version",
+    "ua_string",
+]
+
+_RELATION_OPERATORS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "<=": operator.le,
+    "<": operator.lt,
+}
+
+
+def _never(a: int, b: int) -> bool:
+    return False
 
 
 class BrowserVersionTerm:
@@ -19,23 +59,28 @@ class BrowserVersionTerm:
         self.version = version
         self.relation = relation
 
-    def matches(self, engine: str, version: int) -> bool:
-        if self.engine.lower() != engine.lower():
-            return False
-
-        match self.relation:
-            case ">":
-                return version > self.version
-            case ">=":
-                return version >= self.version
-            case "==":
-                return version == self.version
-            case "<=":
-                return version <= self.version
-            case "<":
-                return version < self.version
-            case _:
-                return False
+        # Engine names are interned so that comparisons against interned row
+        # values in `count_csv_matches` can short-circuit on identity.
+        self._engine_lower = sys.intern(engine.lower())
+        self._compare = _RELATION_OPERATORS.get(relation, _never)
+
+    def check(self) -> tuple[str, Callable[[int, int], bool], int]:
+        """
+        Return an `(engine_lower, compare, version)` tuple describing this term.
+
+        A lower-cased browser engine name and version match the term if the name
+        equals `engine_lower` and `compare(version, term_version)` is true.
+        """
+        return (self._engine_lower, self._compare, self.version)
+
+    def matches_columns(self, engines_lower, versions):
+        """
+        Return a boolean array indicating which entries in arrays of lower-cased
+        engine names and versions match this term.
+        """
+        return (engines_lower == self._engine_lower) & self._compare(
+            versions, self.version
+        )
 
 
 def parse_query(query: str) -> list[BrowserVersionTerm]:
@@ -44,7 +89,7 @@ def parse_query(query: str) -> list[BrowserVersionTerm]:
     """
     matchers = []
     for term in query.split(","):
-        match = re.match("(\\w+)\\s*(<|<=|==|>=|>)\\s*(\\d+)", term)
+        match = _QUERY_TERM_RE.match(term)
         if not match:
             raise ValueError(f'Unable to parse query "{term}"')
         engine, relation, version = match.groups()
@@ -53,13 +98,238 @@ def parse_query(query: str) -> list[BrowserVersionTerm]:
     return matchers
 
 
+def parse_version(version: str) -> Optional[int]:
+    """
+    Parse a browser engine version from the output of parse_access_log.py.
+
+    Returns `None` if the version is not a number.
+    """
+    try:
+        return int(version)
+    except ValueError:
+        return None
+
+
+def split_csv_row(line: bytes) -> list[bytes]:
+    """
+    Split a line from a CSV file produced by parse_access_log.py into columns.
+
+    In the output of parse_access_log.py only the final User-Agent column is
+    ever quoted in practice, so most lines can be split using `bytes.split`,
+    which is much faster than `csv.reader`. Other lines are parsed using
+    `csv.reader`.
+    """
+    line = line.rstrip(b"\r\n")
+    row = line.split(b",", 4)
+    if len(row) == 5:
+        user_agent = row[4]
+        quote_pos = line.find(b'"')
+        if quote_pos == -1:
+            if b"," not in user_agent:
+                return row
+        elif (
+            quote_pos == len(line) - len(user_agent)
+            and len(user_agent) > 1
+            and user_agent.endswith(b'"')
+        ):
+            # Any quotes inside the quoted column must be escaped as `""`.
+            # Otherwise the line contains extra columns.
+            user_agent = user_agent[1:-1]
+            if b'"' not in user_agent.replace(b'""', b""):
+                row[4] = user_agent.replace(b'""', b'"')
+                return row
+    return [column.encode() for column in next(csv.reader([line.decode()]))]
+
+
+def count_csv_matches(
+    path: str, terms: list[BrowserVersionTerm]
+) -> tuple[int, int, int]:
+    """
+    Count rows in a CSV file produced by parse_access_log.py matching a query.
+
+    Returns a `(n_valid_rows, n_skipped_rows, n_matches)` tuple.
+    """
+    n_skipped_rows = 0
+    n_valid_rows = 0
+    n_matches = 0
+
+    # Mapping of engine name to interned lower-cased name. There are only a
+    # handful of distinct engine names, so this avoids lower-casing each row.
+    lower_engines = {}
+
+    # Unpack each term up front, to avoid a generator and method call per row.
+    term_checks = [term.check() for term in terms]
+
+    with open(path, "rb") as csv_file:
+        # Process the file as bytes, to avoid the cost of decoding the whole
+        # file. Only engine names are decoded, and only once per distinct name.
+        # Regular files are memory-mapped to avoid the cost of buffered reads.
+        # Other files, such as pipes, can't be memory-mapped and are read
+        # normally.
+        file_stat = os.fstat(csv_file.fileno())
+        if stat.S_ISREG(file_stat.st_mode):
+            if file_stat.st_size == 0:
+                # Empty files can't be memory-mapped.
+                return (0, 0, 0)
+            data = mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ)
+            lines = iter(data.readline, b"")
+        else:
+            data = contextlib.nullcontext()
+            lines = csv_file
+
+        with data:
+            for line in lines:
+                row = split_csv_row(line)
+                if len(row) != 5:
+                    # Number of columns doesn't match expected count
+                    n_skipped_rows += 1
+                    continue
+                browser, browser_version, engine, engine_version, user_agent = row
+
+                if not engine or not engine_version:
+                    # Browser engine or version could not be identified
+                    n_skipped_rows += 1
+                    continue
+
+                try:
+                    engine_version = int(engine_version)
+                except ValueError:
+                    # `int` only accepts ASCII digits in bytes, so decode the
+                    # version to handle other Unicode decimal digits.
+                    try:
+                        engine_version = parse_version(engine_version.decode())
+                    except UnicodeDecodeError:
+                        engine_version = None
+                    if engine_version is None:
+                        # Engine version is not a number
+                        n_skipped_rows += 1
+                        continue
+
+                n_valid_rows += 1
+                engine_lower = lower_engines.get(engine)
+                if engine_lower is None:
+                    engine_lower = lower_engines[engine] = sys.intern(
+                        engine.decode().lower()
+                    )
+                for term_engine_lower, compare, term_version in term_checks:
+                    if engine_lower == term_engine_lower and compare(
+                        engine_version, term_version
+                    ):
+                        n_matches += 1
+                        break
+
+    return (n_valid_rows, n_skipped_rows, n_matches)
+
+
+def _count_vectorized_matches(engines, versions, terms) -> int:
+    """
+    Count entries in arrays of valid engines and versions matching a query.
+    """
+    engines_lower = engines.str.lower()
+    matches = False
+    for term in terms:
+        matches = matches | term.matches_columns(engines_lower, versions)
+    return int(matches.sum())
+
+
+def count_csv_matches_vectorized(
+    path: str, terms: list[BrowserVersionTerm]
+) -> tuple[int, int, int]:
+    """
+    Vectorized version of `count_csv_matches`.
+
+    This requires pandas and pyarrow.
+    """
+    n_invalid_rows = 0
+
+    def skip_invalid_row(row):
+        # Number of columns doesn't match expected count
+        nonlocal n_invalid_rows
+        n_invalid_rows += 1
+        return "skip"
+
+    # Read through a Python file object, as `pa_csv.read_csv` requires paths to
+    # be seekable, which pipes are not.
+    with open(path, "rb") as csv_file:
+        if not csv_file.peek(1):
+            # pyarrow rejects empty CSV files.
+            return (0, 0, 0)
+        table = pa_csv.read_csv(
+            csv_file,
+            read_options=pa_csv.ReadOptions(column_names=_COLUMN_NAMES),
+            parse_options=pa_csv.ParseOptions(
+                invalid_row_handler=skip_invalid_row, ignore_empty_lines=False
+            ),
+            convert_options=pa_csv.ConvertOptions(
+                include_columns=["equivalent_name", "equivalent_version"],
+                column_types={name: pa.string() for name in _COLUMN_NAMES},
+                strings_can_be_null=False,
+            ),
+        )
+    df = table.to_pandas()
+    total_rows = len(df) + n_invalid_rows
+
+    # Parse each distinct engine version the same way as `count_csv_matches`.
+    # There are few distinct versions, so this is cheap.
+    parsed_versions = {}
+    for version in df.equivalent_version.unique():
+        parsed_version = parse_version(version)
+        if parsed_version is not None:
+            parsed_versions[version] = parsed_version
+
+    # Skip rows where the browser engine or version could not be identified,
+    # or the engine version is not a number.
+    df = df[
+        (df.equivalent_name != "")
+        & df.equivalent_version.isin(list(parsed_versions))
+    ]
+    n_valid_rows = len(df)
+
+    n_matches = _count_vectorized_matches(
+        df.equivalent_name, df.equivalent_version.map(parsed_versions), terms
+    )
+    return (n_valid_rows, total_rows - n_valid_rows, n_matches)
+
+
+def count_parquet_matches(
+    path: str, terms: list[BrowserVersionTerm]
+) -> tuple[int, int, int]:
+    """
+    Count rows in a Parquet file produced by parse_access_log.py matching a query.
+
+    Rows are matched against all the query terms at once using vectorized
+    operations. This requires pandas and pyarrow.
+
+    Returns a `(n_valid_rows, n_skipped_rows, n_matches)` tuple.
+    """
+    table = pq.read_table(path, columns=["equivalent_name", "equivalent_version"])
+    df = table.to_pandas()
+    total_rows = len(df)
+
+    # Skip rows where the browser engine or version could not be identified.
+    df = df[
+        df.equivalent_name.notna()
+        & (df.equivalent_name != "")
+        & df.equivalent_version.notna()
+    ]
+    n_valid_rows = len(df)
+
+    n_matches = _count_vectorized_matches(
+        df.equivalent_name, df.equivalent_version.astype("int64"), terms
+    )
+    return (n_valid_rows, total_rows - n_valid_rows, n_matches)
+
+
 def main():
     parser = ArgumentParser(
         description="""
 Match user agent details against a browser version query.
 """
     )
-    parser.add_argument("csv_file", help="CSV file produced by parse_access_log.py")
+    parser.add_argument(
+        "csv_file",
+        help="CSV or Parquet (*.parquet) file produced by parse_access_log.py",
+    )
     parser.add_argument(
         "query",
         help="Query to match each row against. eg. 'chrome>=90,safari>=14,firefox>=90'",
@@ -68,35 +338,20 @@ Match user agent details against a browser version query.
 
     terms = parse_query(args.query)
 
-    n_skipped_rows = 0
-    n_valid_rows = 0
-    n_matches = 0
-
-    with open(args.csv_file) as csv_file:
-        reader = csv.reader(csv_file)
-        for row in reader:
-            try:
-                browser, browser_version, engine, engine_version, user_agent = row
-            except ValueError:
-                # Number of columns doesn't match expected count
-                n_skipped_rows += 1
-                continue
-
-            if not engine or not engine_version:
-                # Browser engine or version could not be identified
-                n_skipped_rows += 1
-                continue
-
-            try:
-                engine_version = int(engine_version)
-            except ValueError:
-                # Engine version is not a number
-                n_skipped_rows += 1
-                continue
-
-            n_valid_rows += 1
-            if any(term.matches(engine, engine_version) for term in terms):
-                n_matches += 1
+    if args.csv_file.endswith(".parquet"):
+        if pa is None:
+            parser.error("Reading Parquet files requires pandas and pyarrow")
+        n_valid_rows, n_skipped_rows, n_matches = count_parquet_matches(
+            args.csv_file, terms
+        )
+    elif pa is not None:
+        n_valid_rows, n_skipped_rows, n_matches = count_csv_matches_vectorized(
+            args.csv_file, terms
+        )
+    else:
+        n_valid_rows, n_skipped_rows, n_matches = count_csv_matches(
+            args.csv_file, terms
+        )
 
     if n_valid_rows == 0:
         print("CSV file is empty", file=sys.stderr)
@@ -1,9 +1,44 @@
 #!/usr/bin/env python3
 
+from argparse import ArgumentParser
 import csv
+import functools
+import itertools
+import multiprocessing
+import os
 import re
+import string
 import sys
 
+try:
+    # RE2 matches in linear time, avoiding pathological backtracking on
+    # malformed log lines. See https://pypi.org/project/google-re2/.
+    import re2 as re_fast
+except ImportError:
+    re_fast = re
+
+
+# The "combined" log line format consists of:
+#
+# $remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent
+# "$http_referer" "$http_user_agent"
+_ip_pat = "[0-9.]{4}"
+_user_pat = "[^ ]+"
+_time_pat = r"[^\]]+"
+_quoted_str_pat = '[^"]*'
+_number_pat = "[0-9]+"
+_COMBINED_RE = re_fast.compile(
+    rf'({_ip_pat}) - ({_user_pat}) \[({_time_pat})\] "({_quoted_str_pat})" ({_number_pat}) ({_number_pat}) "({_quoted_str_pat})" "({_quoted_str_pat})"'
+)
+
+# Product name and optional version at the start of a User-Agent product token.
+_NAME_VERSION_RE = re.compile(r"([\w .]+)(/([^ ]+))?")
+
+# Platform information patterns found in the comment of the `Mozilla/5.0` token.
+_IOS_RE = re.compile(r"(?:iPhone|CPU) OS ([0-9_]+)")
+_MACOS_RE = re.compile(r"Mac OS X ([0-9]+_[0-9_]+)")
+_TRIDENT_RE = re.compile(r"Trident/7.0; rv:([0-9.]+)")
+
 
 class AccessLogEntry:
     """
@@ -22,6 +57,71 @@ class AccessLogEntry:
         self.user_agent = user_agent
 
 
+def _is_ascii_number(value):
+    return value.isascii() and value.isdigit()
+
+
+def _split_combined_log_line(line):
+    """
+    Split an nginx "combined" format log line into fields using string searches.
+
+    This is much cheaper than matching `_COMBINED_RE` against every line.
+
+    Returns a tuple of `AccessLogEntry` constructor arguments, or `None` if the
+    line does not have the expected structure. Where this returns fields, they
+    are the same as `_COMBINED_RE` would produce, except that `remote_addr` is
+    the complete address.
+    """
+    try:
+        # `$remote_addr - $remote_user [$time_local]`. Content in front of the
+        # log line, such as a Papertrail prefix, may also contain " - ". As with
+        # `_COMBINED_RE`, use the first " - " which follows an address.
+        addr_end = line.index(" - ")
+        while addr_end < 4 or line[addr_end - 4 : addr_end].strip("0123456789."):
+            addr_end = line.index(" - ", addr_end + 1)
+        addr_start = line.rfind(" ", 0, addr_end) + 1
+        user_end = line.index(" ", addr_end + 3)
+        if user_end == addr_end + 3 or not line.startswith("[", user_end + 1):
+            return None
+        time_end = line.index("]", user_end + 2)
+        if time_end == user_end + 2:
+            return None
+
+        # `"$request" $status $body_bytes_sent`
+        if not line.startswith(' "', time_end + 1):
+            return None
+        request_start = time_end + 3
+        request_end = line.index('"', request_start)
+        referrer_start = line.index('"', request_end + 1) + 1
+        numbers = line[request_end + 1 : referrer_start - 1]
+        if numbers[:1] != " " or numbers[-1:] != " ":
+            return None
+        status, body_size = numbers[1:-1].split(" ")
+        if not (_is_ascii_number(status) and _is_ascii_number(body_size)):
+            return None
+        status = int(status)
+        body_size = int(body_size)
+
+        # `"$http_referer" "$http_user_agent"`
+        referrer_end = line.index('"', referrer_start)
+        if not line.startswith(' "', referrer_end + 1):
+            return None
+        user_agent_start = referrer_end + 3
+        user_agent_end = line.index('"', user_agent_start)
+    except ValueError:
+        return None
+
+    return (
+        line[addr_start:addr_end],
+        line[user_end + 2 : time_end],
+        line[request_start:request_end],
+        status,
+        body_size,
+        line[referrer_start:referrer_end],
+        line[user_agent_start:user_agent_end],
+    )
+
+
 def parse_nginx_combined_log(lines):
     """
     Parse an nginx access log using the default "combined" format.
@@ -34,31 +134,25 @@ def parse_nginx_combined_log(lines):
     line.
     """
 
-    # The "combined" log line format consists of:
-    #
-    # $remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent
-    # "$http_referer" "$http_user_agent"
-
-    ip_pat = "[0-9.]{4}"
-    user_pat = "[^ ]+"
-    time_pat = "[^]]+"
-    quoted_str_pat = '[^"]*'
-    number_pat = "[0-9]+"
-    combined_pat = f'({ip_pat}) - ({user_pat}) \[({time_pat})\] "({quoted_str_pat})" ({number_pat}) ({number_pat}) "({quoted_str_pat})" "({quoted_str_pat})"'
-
     for line in lines:
-        match = re.search(combined_pat, line)
-        if not match:
-            raise Exception(f"Failed to parse log line `{line}`")
-        yield AccessLogEntry(
-            remote_addr=match[1],
-            date_str=match[3],
-            request=match[4],
-            status=int(match[5]),
-            body_size=int(match[6]),
-            referrer=match[7],
-            user_agent=match[8],
-        )
+        fields = _split_combined_log_line(line)
+        if fields is None:
+            # Fall back to the regex for lines which the fast path could not
+            # handle, eg. because the first address in the line is not followed
+            # by the rest of a log entry.
+            match = _COMBINED_RE.search(line)
+            if not match:
+                raise Exception(f"Failed to parse log line `{line}`")
+            fields = (
+                match[1],
+                match[3],
+                match[4],
+                int(match[5]),
+                int(match[6]),
+                match[7],
+                match[8],
+            )
+        yield AccessLogEntry(*fields)
 
 
 def parse_user_agent(user_agent_str):
@@ -75,39 +169,103 @@ def parse_user_agent(user_agent_str):
     Returns a list of (product_name, version, comment) tuples.
     """
 
-    name_version_pat = "^([\w .]+)(/([^ ]+))?"
     product_tokens = []
 
+    # Parse the header by moving a cursor through it, rather than repeatedly
+    # slicing off the parsed part, to avoid copying the rest of the string
+    # for each token.
     user_agent_str = user_agent_str.strip()
+    end = len(user_agent_str)
+    pos = 0
 
     while True:
         # Parse product name and version.
-        match = re.match(name_version_pat, user_agent_str)
+        match = _NAME_VERSION_RE.match(user_agent_str, pos)
         if not match:
             break
         name = match[1]
         version = match[3]
-        user_agent_str = user_agent_str[len(match[0]) :].strip()
+        pos = match.end()
+        while pos < end and user_agent_str[pos].isspace():
+            pos += 1
 
         # Parse comment.
         comment = None
-        if len(user_agent_str) and user_agent_str[0] == "(":
+        if pos < end and user_agent_str[pos] == "(":
+            # Find the matching closing paren by jumping between parens with
+            # `str.find`, rather than testing each character. Comments usually
+            # don't contain nested parens, so this typically takes one step.
+            # If there is no matching paren, the comment extends to the end
+            # of the string.
             depth = 1
-            for pos in range(1, len(user_agent_str)):
-                if user_agent_str[pos] == "(":
+            search_pos = pos + 1
+            while True:
+                close_pos = user_agent_str.find(")", search_pos)
+                if close_pos == -1:
+                    comment_end = end - 1
+                    break
+                open_pos = user_agent_str.find("(", search_pos, close_pos)
+                if open_pos != -1:
                     depth += 1
-                elif user_agent_str[pos] == ")":
-                    depth -= 1
-                    if depth == 0:
-                        break
-            comment = user_agent_str[1:pos]
-            user_agent_str = user_agent_str[pos + 1 :].strip()
+                    search_pos = open_pos + 1
+                    continue
+                depth -= 1
+                if depth == 0:
+                    comment_end = close_pos
+                    break
+                search_pos = close_pos + 1
+            comment = user_agent_str[pos + 1 : comment_end]
+            pos = comment_end + 1
+            while pos < end and user_agent_str[pos].isspace():
+                pos += 1
 
         product_tokens.append((name, version, comment))
 
     return product_tokens
 
 
+try:
+    # Use compiled versions of the per-line parsing functions if the optional
+    # `_fast` extension has been built. See README.
+    from _fast import (
+        parse_user_agent,
+        split_combined_log_line as _split_combined_log_line,
+    )
+except ImportError:
+    pass
+
+
+# Product names which are commonly included in User-Agent headers for compatibility
+# reasons, from most to least generic.
+_GENERIC_PRODUCT_NAMES = [
+    # Most browser user agents start with "Mozilla/5.0".
+    "Mozilla",
+    # All Firefox user agents include "Gecko/<Version>". Most browser user
+    # agents include "like Gecko", but that appears in a comment.
+    "Gecko",
+    # Most modern browser user agents include "AppleWebKit" or "Safari" for
+    # mobile web compatibility. For non-Safari user agents, the version is
+    # typically fixed at "537.36". In recent Safari versions the AppleWebKit
+    # product version is frozen at "605.1.15".
+    "AppleWebKit",
+    "Safari",
+    "Mobile Safari",
+    # iOS applications with an embedded browser will contain `Mobile/15E148`
+    # or similar. In this case the User Agent may not the equivalent Safari
+    # version, however it can be inferred from the iOS/iPhone OS/iPad OS version.
+    "Mobile",
+    # Chrome-derived browsers will include Chrome in the UA. Some non-Chrome
+    # user agents may include Chrome as well.
+    "Chrome",
+]
+
+# Mapping of generic product name to sort priority for `sort_user_agent_tokens`.
+_GENERIC_PRIORITY = {
+    name: len(_GENERIC_PRODUCT_NAMES) - i
+    for i, name in enumerate(_GENERIC_PRODUCT_NAMES)
+}
+
+
 def sort_user_agent_tokens(tokens):
     """
     Sort parsed tokens from a User-Agent header in order of uniqueness.
@@ -119,40 +277,23 @@ def sort_user_agent_tokens(tokens):
     subsequent tokens providing fallbacks to recognize a user agent if the specific
     UA is not recognized.
     """
-    generic_product_names = [
-        # Most browser user agents start with "Mozilla/5.0".
-        "Mozilla",
-        # All Firefox user agents include "Gecko/<Version>". Most browser user
-        # agents include "like Gecko", but that appears in a comment.
-        "Gecko",
-        # Most modern browser user agents include "AppleWebKit" or "Safari" for
-        # mobile web compatibility. For non-Safari user agents, the version is
-        # typically fixed at "537.36". In recent Safari versions the AppleWebKit
-        # product version is frozen at "605.1.15".
-        "AppleWebKit",
-        "Safari",
-        "Mobile Safari",
-        # iOS applications with an embedded browser will contain `Mobile/15E148`
-        # or similar. In this case the User Agent may not the equivalent Safari
-        # version, however it can be inferred from the iOS/iPhone OS/iPad OS version.
-        "Mobile",
-        # Chrome-derived browsers will include Chrome in the UA. Some non-Chrome
-        # user agents may include Chrome as well.
-        "Chrome",
-    ]
-
-    def token_priority(token):
-        name = token[0]
-        try:
-            return len(generic_product_names) - generic_product_names.index(name)
-        except ValueError:
-            return -1
-
-    return sorted(tokens, key=token_priority)
+    return sorted(tokens, key=lambda token: _GENERIC_PRIORITY.get(token[0], -1))
 
 
+@functools.lru_cache(maxsize=1024)
 def get_major_version(version_str):
-    return version_str.split(".")[0]
+    dot_pos = version_str.find(".")
+    return version_str[:dot_pos] if dot_pos != -1 else version_str
+
+
+# Product names which identify a Chrome-based browser, for
+# `equivalent_major_browser`.
+_CHROME_PRODUCT_NAMES = {
+    "Chrome": "Chrome",
+    "Brave Chrome": "Chrome",
+    "like Chrome": "Chrome",
+    "HeadlessChrome": "Chrome",
+}
 
 
 def equivalent_major_browser(user_agent_tokens):
@@ -167,27 +308,31 @@ def equivalent_major_browser(user_agent_tokens):
     data on MDN or caniuse.com.
     """
 
-    def find_token(*names):
-        matches = [t for t in user_agent_tokens if t[0] in names]
-        return matches[0] if matches else None
+    # Index tokens by product name in a single pass. Where several tokens have
+    # the same name, the first one wins. Chrome-equivalent product names are
+    # grouped under "Chrome".
+    tokens_by_name = {}
+    for token in user_agent_tokens:
+        name = _CHROME_PRODUCT_NAMES.get(token[0], token[0])
+        tokens_by_name.setdefault(name, token)
 
     # Find EdgeHTML-based versions of Edge. Note that modern Edge versions use
     # "Edg" as the product token and are Chrome-based.
-    edge_legacy_token = find_token("Edge")
+    edge_legacy_token = tokens_by_name.get("Edge")
     if edge_legacy_token:
         return ("Edge (Legacy)", get_major_version(edge_legacy_token[1]))
 
-    firefox_token = find_token("Firefox")
+    firefox_token = tokens_by_name.get("Firefox")
     if firefox_token:
         return ("Firefox", get_major_version(firefox_token[1]))
 
     # Check for Chrome-based browsers. This comes after the check for Edge (Legacy)
     # because Edge Legacy had to pretend to be Chrome for web compatibility reasons.
-    chrome_token = find_token("Chrome", "Brave Chrome", "like Chrome", "HeadlessChrome")
+    chrome_token = tokens_by_name.get("Chrome")
     if chrome_token:
         return ("Chrome", get_major_version(chrome_token[1]))
 
-    safari_token = find_token("Version")
+    safari_token = tokens_by_name.get("Version")
     if safari_token:
         return ("Safari", get_major_version(safari_token[1]))
 
@@ -195,12 +340,15 @@ def equivalent_major_browser(user_agent_tokens):
     # the browser engine. In this situation we fall back to inferring it from
     # the platform information contained in the comment of the `Mozilla/5.0`
     # product token.
-    moz_token = find_token("Mozilla")
+    moz_token = tokens_by_name.get("Mozilla")
     platform_info = moz_token[2] if moz_token else None
     if platform_info:
         # Embedded web views on iOS all run the same WebKit release as Safari.
         # The WebKit/Safari version can be inferred from the iOS version.
-        ios_version_match = re.search("(?:iPhone|CPU) OS ([0-9_]+)", platform_info)
+        #
+        # The substring checks before each regex search below skip the much
+        # more expensive regex search for most user agents.
+        ios_version_match = "OS " in platform_info and _IOS_RE.search(platform_info)
         if ios_version_match:
             ios_version = ios_version_match[1].replace("_", ".")
             return ("Safari", get_major_version(ios_version))
@@ -208,7 +356,9 @@ def equivalent_major_browser(user_agent_tokens):
         # If a web page on iOS is being presented with the "Request Desktop Site" mode,
         # then the user agent changes to be a macOS user agent. As of 2020-10,
         # the macOS "version" is hard-coded. See https://bugs.webkit.org/show_bug.cgi?id=196275.
-        macos_version_match = re.search("Mac OS X ([0-9]+_[0-9_]+)", platform_info)
+        macos_version_match = "Mac OS X " in platform_info and _MACOS_RE.search(
+            platform_info
+        )
         if macos_version_match:
             major_version, minor_version, *patch_version = macos_version_match[1].split(
                 "_"
@@ -226,7 +376,7 @@ def equivalent_major_browser(user_agent_tokens):
 
         # Internet Explorer version information is contained inside the comment
         # of the Mozilla/5.0 token, rather than being its own token.
-        ie_match = re.search("Trident/7.0; rv:([0-9.]+)", platform_info)
+        ie_match = "Trident/7" in platform_info and _TRIDENT_RE.search(platform_info)
         if ie_match:
             ie_version = ie_match[1]
             return ("Internet Explorer", get_major_version(ie_version))
@@ -279,41 +429,215 @@ def is_user_agent_a_bot(tokens):
     # a bot.
     for term in terms:
         # Match names like "Googlebot" or "FooBot".
-        if re.match(".*bot$", term, re.IGNORECASE):
+        if term.lower().endswith("bot"):
             return True
 
         # Match names like "Pingdom_bot_1.0"
-        if re.search("[^A-Za-z]bot[^A-Za-z]", name, re.IGNORECASE):
+        if _contains_delimited_bot(name):
             return True
 
     return False
 
 
-csv_writer = csv.writer(sys.stdout)
-for entry in parse_nginx_combined_log(line.strip() for line in sys.stdin):
-    # Skip entries with no User-Agent header.
-    if entry.user_agent == "-":
-        continue
+# Translation table which lower-cases ASCII letters only, so that character
+# positions in the result match those in the original string.
+_ASCII_LOWERCASE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+# Characters matched by `[A-Za-z]` in a case-insensitive regex. Besides ASCII
+# letters, this includes non-ASCII characters which case-fold to ASCII letters.
+_CASE_INSENSITIVE_LETTERS = frozenset(
+    string.ascii_letters + "\u0130\u0131\u017f\u212a"  # İ ı ſ K (Kelvin sign)
+)
+
+
+def _contains_delimited_bot(name):
+    """
+    Return true if "bot" appears in `name` surrounded by non-letter characters.
+
+    This is equivalent to a case-insensitive search for `[^A-Za-z]bot[^A-Za-z]`.
+    """
+    folded_name = name.translate(_ASCII_LOWERCASE)
+    pos = folded_name.find("bot", 1)
+    while pos != -1 and pos + 3 < len(name):
+        if (
+            name[pos - 1] not in _CASE_INSENSITIVE_LETTERS
+            and name[pos + 3] not in _CASE_INSENSITIVE_LETTERS
+        ):
+            return True
+        pos = folded_name.find("bot", pos + 1)
+    return False
+
+
+@functools.lru_cache(maxsize=4096)
+def _classify_ua(user_agent_str):
+    """
+    Parse a User-Agent header and identify the browser it belongs to.
+
+    The same User-Agent strings occur many times in a typical access log, so
+    results are cached.
 
-    # Skip entries from likely bots.
-    tokens = parse_user_agent(entry.user_agent)
-    if is_user_agent_a_bot(tokens):
-        continue
+    Returns an `(is_bot, browser_info)` tuple where `browser_info` is a
+    `(name, version_major, compat_name, compat_version)` tuple, or `None` if
+    the user agent could not be parsed.
+    """
+    tokens = parse_user_agent(user_agent_str)
+
+    # All of the names which `is_user_agent_a_bot` looks for contain "bot", so
+    # most user agents can skip the more expensive check.
+    if "bot" in user_agent_str.lower() and is_user_agent_a_bot(tokens):
+        return (True, None)
 
     tokens = sort_user_agent_tokens(tokens)
     compat_token = equivalent_major_browser(tokens)
 
-    if tokens:
-        main_token = tokens[0]
-        name = main_token[0]
-        name = ua_product_name_to_browser.get(name) or name
-        version = main_token[1]
-        version_major = get_major_version(version) if version else None
-        compat_name = compat_token[0] if compat_token else None
-        compat_version = compat_token[1] if compat_token else None
-
-        csv_writer.writerow(
-            [name, version_major, compat_name, compat_version, entry.user_agent]
-        )
-    else:
-        print("Failed to parse user agent: ", entry.user_agent, file=sys.stderr)
+    if not tokens:
+        return (False, None)
+
+    main_token = tokens[0]
+    name = main_token[0]
+    name = ua_product_name_to_browser.get(name) or name
+    version = main_token[1]
+    version_major = get_major_version(version) if version else None
+    compat_name = compat_token[0] if compat_token else None
+    compat_version = compat_token[1] if compat_token else None
+
+    return (False, (name, version_major, compat_name, compat_version))
+
+
+def _process_chunk(lines):
+    """
+    Extract browser information from a chunk of nginx access log lines.
+
+    Returns a `(rows, failed_user_agents)` tuple of CSV rows and User-Agent
+    strings which could not be parsed.
+    """
+    rows = []
+    failed_user_agents = []
+    for entry in parse_nginx_combined_log(line.strip() for line in lines):
+        # Skip entries with no User-Agent header.
+        if entry.user_agent == "-":
+            continue
+
+        # Skip entries from likely bots.
+        is_bot, browser_info = _classify_ua(entry.user_agent)
+        if is_bot:
+            continue
+
+        if browser_info:
+            rows.append([*browser_info, entry.user_agent])
+        else:
+            failed_user_agents.append(entry.user_agent)
+    return (rows, failed_user_agents)
+
+
+def _write_csv(row_chunks):
+    """
+    Write chunks of rows to stdout in CSV format.
+    """
+    with open(
+        sys.stdout.fileno(),
+        "w",
+        buffering=_OUTPUT_BUFFER_SIZE,
+        encoding=sys.stdout.encoding,
+        errors=sys.stdout.errors,
+        newline="",
+        closefd=False,
+    ) as output:
+        csv_writer = csv.writer(output)
+        for rows in row_chunks:
+            csv_writer.writerows(rows)
+
+
+def _write_parquet(row_chunks):
+    """
+    Write chunks of rows to stdout in Parquet format, one row group per chunk.
+
+    The User-Agent string column is omitted and the equivalent browser version
+    is stored as a 64-bit integer, so that analyze_stats.py can load the data
+    it needs directly into columns. Versions are parsed the same way as
+    analyze_stats.py parses them from CSV files. The rare versions which do not
+    fit in 64 bits are stored as null, and skipped like non-numeric versions.
+    """
+    # pyarrow is an optional dependency, only needed for Parquet output.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    from analyze_stats import parse_version
+
+    def parse_int64(version):
+        # Missing versions are written to CSV files as "".
+        version = parse_version(version or "")
+        if version is None or not -(2**63) <= version < 2**63:
+            return None
+        return version
+
+    schema = pa.schema(
+        [
+            ("browser_name", pa.string()),
+            ("browser_version", pa.string()),
+            ("equivalent_name", pa.string()),
+            ("equivalent_version", pa.int64()),
+        ]
+    )
+
+    with pq.ParquetWriter(sys.stdout.buffer, schema) as writer:
+        for rows in row_chunks:
+            if not rows:
+                continue
+            names, versions, compat_names, compat_versions, _ = zip(*rows)
+            columns = [
+                names,
+                versions,
+                compat_names,
+                [parse_int64(v) for v in compat_versions],
+            ]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+
+
+# Number of log lines to send to a worker process at a time.
+_CHUNK_SIZE = 10_000
+
+# Size of the CSV output buffer, in bytes.
+_OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+_OUTPUT_WRITERS = {
+    "csv": _write_csv,
+    "parquet": _write_parquet,
+}
+
+
+def main():
+    parser = ArgumentParser(
+        description="""
+Extract browser version information from an nginx access log read from stdin.
+"""
+    )
+    parser.add_argument(
+        "--ordered",
+        action="store_true",
+        help="Output rows in the same order as the log lines they came from",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=list(_OUTPUT_WRITERS),
+        default="csv",
+        help="Format of the output written to stdout",
+    )
+    args = parser.parse_args()
+
+    chunks = iter(lambda: list(itertools.islice(sys.stdin, _CHUNK_SIZE)), [])
+
+    with multiprocessing.Pool(os.cpu_count()) as pool:
+        imap = pool.imap if args.ordered else pool.imap_unordered
+
+        def row_chunks():
+            for rows, failed_user_agents in imap(_process_chunk, chunks, chunksize=1):
+                for user_agent in failed_user_agents:
+                    print("Failed to parse user agent: ", user_agent, file=sys.stderr)
+                yield rows
+
+        _OUTPUT_WRITERS[args.output_format](row_chunks())
+
+
+if __name__ == "__main__":
+    main()